@@ -1,15 +1,41 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, g, request, jsonify, render_template, session
+from flask.sessions import SessionInterface
+from flask.json.provider import JSONProvider
+from flask_session import Session
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from supabase import create_client, Client
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from datetime import datetime, timedelta
+from googleapiclient.errors import HttpError
+from dateparser.search import search_dates
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import atexit
+import contextlib
+import functools
+import hashlib
+import httplib2
+import httpx
+import importlib.util
 import logging
-import json
+import numpy as np
+import orjson
 import os
-import pytz
-import speech_recognition as sr
+import queue
+import random
+import redis
 import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
 
 # Load configuration
 try:
@@ -20,95 +46,1031 @@ except ImportError:
     SUPABASE_URL = os.getenv('SUPABASE_URL')
     SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider that encodes and decodes with orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=str), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 🔹 Configure server-side sessions (shared by all workers through Redis)
+app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY')
+if not app.config['SECRET_KEY']:
+    # A per-process key only works with a single worker (gunicorn.conf.py
+    # refuses to start several without FLASK_SECRET_KEY)
+    logger.warning("FLASK_SECRET_KEY is not set; using a random key, so sessions won't survive a restart")
+    app.config['SECRET_KEY'] = os.urandom(24)
+try:
+    session_redis = redis.from_url(REDIS_URL)
+    session_redis.ping()
+    app.config.update(SESSION_TYPE='redis', SESSION_REDIS=session_redis)
+    Session(app)
+except Exception as e:
+    # Without Redis, fall back to Flask's signed-cookie sessions, which every
+    # worker can read as long as they share FLASK_SECRET_KEY
+    logger.error(f"Redis session store unavailable: {e}")
+    logger.warning("Using signed-cookie sessions: chat history is trimmed to stay under the browser's 4 KB cookie limit")
+    session_redis = None
+
+# 🔹 Serialize requests that share a session
+SESSION_LOCK_TIMEOUT = 60  # seconds
+
+def acquire_session_lock(sid):
+    """Wait until no other request holds session sid and return a release callback.
+
+    The lock lives in Redis alongside the session, so it spans workers.
+    """
+    lock = session_redis.lock(f"session-lock:{sid}", timeout=SESSION_LOCK_TIMEOUT, blocking_timeout=SESSION_LOCK_TIMEOUT)
+    if not lock.acquire():
+        logger.warning("Timed out waiting for session lock, continuing without it")
+        return lambda: None
+
+    def release():
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            logger.warning("Session lock expired before the request finished")
+    return release
+
+class LockingSessionInterface(SessionInterface):
+    """Session interface wrapper that runs requests sharing a session one at a time.
+
+    The lock is taken before the session is loaded and released after it has
+    been saved, so concurrent turns can't overwrite each other's chat history
+    or meeting details.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.inner.get_cookie_name(app))
+        if sid:
+            g.release_session_lock = acquire_session_lock(sid)
+        return self.inner.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        return self.inner.save_session(app, session, response)
+
+    def is_null_session(self, obj):
+        return self.inner.is_null_session(obj)
+
+    def make_null_session(self, app):
+        return self.inner.make_null_session(app)
+
+# Only Redis-backed sessions are serialized. A signed-cookie session is the
+# cookie itself, so concurrent requests each start from the copy the browser
+# sent and the last response stored wins; a server-side lock can't help.
+if session_redis:
+    app.session_interface = LockingSessionInterface(app.session_interface)
+
+@app.teardown_request
+def release_session_lock(exc):
+    """Release the session lock once the session has been saved."""
+    release = g.pop('release_session_lock', None)
+    if release:
+        release()
+
+# 🔹 Static scheduler instructions (sent once via Gemini context caching)
+SYSTEM_PROMPT = """You're a warm, friendly meeting scheduler assistant, like a helpful colleague. Each message gives you the current date, what the user said, the email addresses and date/time phrases found in it and the previous meeting details (if any).
+
+Validate and correct the meeting details (title, date, time, timezone, description, agenda, attendees) from the user's message. Follow these rules:
+- If the input modifies an existing meeting (e.g., "title as [new title]", "add attendee"), update only the specified fields and retain other prior details unless explicitly changed.
+- Extract the title if specified; default to "Meeting" if not specified or unclear. Use prior title if input only updates other fields.
+- Parse date relative to the current date (e.g., if today is May 18, 2025: "tomorrow" as 2025-05-19, "22 May" as 2025-05-22); ensure it’s on or after the current date; use prior date if not specified; default to the current date only if no prior date and input is unclear.
+- Some date/time phrases are pre-resolved locally under "Dates found" as "<phrase> = YYYY-MM-DD HH:MM". Treat them as hints only: use one when it agrees with what the user said, and otherwise follow the user's own words. The list may miss phrases or include ones that are not meeting dates. A time of 00:00 means the phrase gave no time.
+- Parse time in 12-hour (e.g., "9:00 a.m.") or 24-hour format; use prior time if not specified; default to 09:00 if unclear.
+- Default timezone to Asia/Kolkata if not specified or invalid; retain prior timezone if available.
+- Extract description if provided; use prior description if not specified; set to empty string if none.
+- If the user requests "points" or an agenda (e.g., "give some points") or if the title implies a topic (e.g., "machine learning"), generate a default agenda based on the title (e.g., for "machine learning": "1. Overview of machine learning\n2. Use cases\n3. Challenges\n4. Latest advancements\n5. Future directions"); otherwise, use prior agenda or set to empty string.
+- Email addresses in the user's message are already extracted and normalized under "Emails found"; use those addresses verbatim for attendees instead of re-parsing them from the message. For names without emails (e.g., "Ramesh"), assign dummy emails (e.g., "ramesh@example.com") and note in the message that emails were assumed. Retain prior attendees unless explicitly changed or removed.
+- Return corrected details in JSON format *only*:
+  ```json
+  {
+    "title": "<corrected_title>",
+    "date": "<YYYY-MM-DD>",
+    "time": "<HH:MM>",
+    "timezone": "<valid_timezone>",
+    "description": "<corrected_description>",
+    "agenda": "<corrected_agenda>",
+    "attendees": ["<email1>", "<email2>", ...]
+  }
+  ```
+If the user says something like "confirm", "it is confirmed", "schedule it", "set the meeting", or variations (e.g., "confirm confirm", "please set the meeting"), return "SCHEDULE" to schedule immediately.
+If the input is unclear or lacks sufficient details, return "CLARIFY: Hmm, I couldn’t catch all the details. Could you clarify the title, date, or attendees?"
+
+Respond with *only* the JSON string, "SCHEDULE", or "CLARIFY:<message>" to avoid parsing issues. Do not include conversational text outside the JSON or CLARIFY message.
+"""
+
+# Turns that are plainly a confirmation or a cancellation skip Gemini entirely
+CONFIRM_INTENT_RE = re.compile(
+    r"^(please\s+)?(yes,?\s+)?(confirm(\s+confirm)?|it is confirmed|schedule( it)?|set (up )?the meeting|go ahead)"
+    r"(\s+(the|this|meeting|it|now|please))*[\s.!]*$"
+)
+CANCEL_INTENT_RE = re.compile(
+    r"^(please\s+)?(cancel|clear|discard|reset|start over)"
+    r"(\s+(the|this|meeting|it|details|everything|please))*[\s.!]*$"
+)
+
+# Characters that can change the JSON brace scanner's state
+JSON_TOKEN_RE = re.compile(r'[{}"\\]')
+
+# Per-request user turn; the only part of the prompt that is not cached
+USER_TURN_TEMPLATE = (
+    'Today: {today_str}\nUser said: "{user_input}"\n'
+    'Emails found: {emails_str}\nDates found: {dates_str}\nPrior: {prior_details_str}'
+)
+
+# Emails as users type or dictate them, e.g. "geek @ gmail.com"
+EMAIL_RE = re.compile(r'[\w.+-]+\s*@\s*[\w-]+(?:\.[\w-]+)*\.[A-Za-z]{2,}')
+
+# Words used to sanity-check dateparser's matches
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+MONTH_NAMES = frozenset((
+    'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+    'november', 'december', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+))
+DATE_HINT_TIME_RE = re.compile(r'\d\s*(?::\d|[ap]\.?m\b)', re.I)
+
+# Few-shot turns stored in the context cache alongside the instructions
+FEW_SHOT_EXAMPLES = [
+    {'role': 'user', 'parts': ['Today: May 18, 2025\nUser said: "Team sync tomorrow at 3 pm with ramesh and priya@acme.com"\nEmails found: priya@acme.com\nDates found: "tomorrow at 3 pm" = 2025-05-19 15:00\nPrior: None']},
+    {'role': 'model', 'parts': ['{"title": "Team sync", "date": "2025-05-19", "time": "15:00", "timezone": "Asia/Kolkata", "description": "", "agenda": "", "attendees": ["ramesh@example.com", "priya@acme.com"]}']},
+    {'role': 'user', 'parts': ['Today: May 18, 2025\nUser said: "confirm the meeting"\nEmails found: none\nDates found: none\nPrior: {"title": "Team sync"}']},
+    {'role': 'model', 'parts': ['SCHEDULE']},
+]
+
+GEMINI_MODEL = 'models/gemini-1.5-flash-001'
+DEFAULT_TIMEZONE = ZoneInfo('Asia/Kolkata')
+MEETING_DURATION = timedelta(minutes=60)
+PROMPT_CACHE_TTL = timedelta(hours=1)
+PROMPT_CACHE_REFRESH_MARGIN = timedelta(minutes=5)
+# Gemini 1.5 refuses to cache contents shorter than this
+PROMPT_CACHE_MIN_TOKENS = 32768
+
+def prompt_cache_eligible(model):
+    """Return True if the static instructions and examples are long enough to cache.
+
+    SYSTEM_PROMPT plus FEW_SHOT_EXAMPLES is about 1k tokens today, so caching
+    is skipped. A token covers at least one byte of UTF-8, so a shorter
+    prefix is ruled out locally without a count_tokens call.
+    """
+    texts = [SYSTEM_PROMPT] + [part for turn in FEW_SHOT_EXAMPLES for part in turn['parts']]
+    if sum(len(text.encode()) for text in texts) < PROMPT_CACHE_MIN_TOKENS:
+        return False
+    return model.count_tokens(FEW_SHOT_EXAMPLES).total_tokens >= PROMPT_CACHE_MIN_TOKENS
+
+def create_prompt_cache():
+    """Create a Gemini context cache holding the static instructions and examples."""
+    return genai.caching.CachedContent.create(
+        model=GEMINI_MODEL,
+        display_name='meeting-scheduler-prompt',
+        system_instruction=SYSTEM_PROMPT,
+        contents=FEW_SHOT_EXAMPLES,
+        ttl=PROMPT_CACHE_TTL,
+    )
+
+def recreate_prompt_cache(stale):
+    """Replace the stale prompt cache, rebind the model to the new one and delete the old one.
+
+    Requests that saw the same stale cache all end up here; only the first to
+    take the lock creates a new (billable) cache, the rest find it replaced.
+    """
+    global llm, prompt_cache
+    with prompt_cache_lock:
+        if prompt_cache is not stale:
+            return
+        prompt_cache = create_prompt_cache()
+        llm = genai.GenerativeModel.from_cached_content(prompt_cache)
+    try:
+        stale.delete()
+    except google_exceptions.NotFound:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not delete the replaced prompt cache: {e}")
+
+def prompt_cache_expired(cache):
+    """Return True if cache's TTL has run out."""
+    expire_time = getattr(cache, 'expire_time', None)
+    return expire_time is not None and expire_time <= datetime.now(timezone.utc)
+
+def refresh_prompt_cache():
+    """Extend the prompt cache TTL before it expires, re-creating it if needed."""
+    while True:
+        time.sleep((PROMPT_CACHE_TTL - PROMPT_CACHE_REFRESH_MARGIN).total_seconds())
+        current = prompt_cache
+        try:
+            current.update(ttl=PROMPT_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Prompt cache refresh failed, re-creating it: {e}")
+            try:
+                recreate_prompt_cache(current)
+            except Exception as e:
+                logger.error(f"Prompt cache re-creation failed: {e}")
+
 # 🔹 Configure Gemini API
+prompt_cache = None
+prompt_cache_lock = threading.Lock()
 try:
     genai.configure(api_key=GEMINI_API_KEY)
-    llm = genai.GenerativeModel('gemini-1.5-flash-001-tuning')
+    llm = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_PROMPT)
+    try:
+        if prompt_cache_eligible(llm):
+            prompt_cache = create_prompt_cache()
+            llm = genai.GenerativeModel.from_cached_content(prompt_cache)
+            threading.Thread(target=refresh_prompt_cache, daemon=True).start()
+    except Exception as e:
+        # Context caching is not available on every tier; send the
+        # instructions uncached.
+        logger.warning(f"Gemini context cache unavailable, using system instruction: {e}")
 except Exception as e:
     logger.error(f"Gemini API config error: {e}")
     llm = None
 
 # 🔹 Configure Supabase
+def use_pooled_postgrest_session(client):
+    """Replace the PostgREST session with a pooled keep-alive client, HTTP/2 if h2 is installed."""
+    postgrest = client.postgrest
+    session = postgrest.session
+    # httpx only speaks HTTP/2 with its optional h2 dependency
+    http2 = importlib.util.find_spec('h2') is not None
+    postgrest.session = httpx.Client(
+        base_url=session.base_url,
+        headers=session.headers,
+        timeout=5.0,
+        http2=http2,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=300)
+    )
+    session.close()
+
 try:
     supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    supabase.table("meetings").select("*").limit(1).execute()
 except Exception as e:
     logger.error(f"Supabase connection failed: {e}")
     supabase = None
 
+if supabase:
+    try:
+        use_pooled_postgrest_session(supabase)
+    except Exception as e:
+        # The client's own session still works, just without the larger pool
+        logger.warning(f"Could not install pooled Supabase session: {e}")
+
+# 🔹 Background Supabase writes
+SUPABASE_INSERT_RETRIES = 5
+SUPABASE_BATCH_SIZE = 50
+SUPABASE_BATCH_WINDOW = 0.2  # seconds
+supabase_queue = queue.Queue()
+supabase_write_lock = threading.Lock()
+
+def is_rate_limited(error):
+    """Return True if a Supabase error is an HTTP 429."""
+    return str(getattr(error, 'code', '')) == '429' or '429' in str(error)
+
+def supabase_insert(table, rows):
+    """Insert rows into Supabase in one request, retrying with exponential backoff on 429."""
+    for attempt in range(SUPABASE_INSERT_RETRIES):
+        try:
+            supabase.table(table).insert(rows).execute()
+            return
+        except Exception as e:
+            if not is_rate_limited(e) or attempt == SUPABASE_INSERT_RETRIES - 1:
+                logger.error(f"Supabase insert of {len(rows)} {table} rows failed: {str(e)}")
+                return
+            delay = 0.5 * 2 ** attempt + random.uniform(0, 0.1)
+            logger.warning(f"Supabase rate limited, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def enqueue_supabase_insert(table, row):
+    """Queue a row for the next batched Supabase insert."""
+    supabase_queue.put((table, row))
+
+def write_supabase_batch(batch):
+    """Insert queued (table, row) pairs with one request per table."""
+    rows_by_table = {}
+    for table, row in batch:
+        rows_by_table.setdefault(table, []).append(row)
+    for table, rows in rows_by_table.items():
+        supabase_insert(table, rows)
+
+def supabase_writer():
+    """Coalesce queued rows for up to SUPABASE_BATCH_WINDOW and write them in batches."""
+    while True:
+        batch = [supabase_queue.get()]
+        deadline = time.monotonic() + SUPABASE_BATCH_WINDOW
+        while len(batch) < SUPABASE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(supabase_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        with supabase_write_lock:
+            write_supabase_batch(batch)
+
+def flush_supabase_queue():
+    """Write any queued rows synchronously, e.g. on shutdown."""
+    with supabase_write_lock:
+        batch = []
+        while True:
+            try:
+                batch.append(supabase_queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch and supabase:
+            logger.info(f"Flushing {len(batch)} queued Supabase rows")
+            write_supabase_batch(batch)
+
+if supabase:
+    threading.Thread(target=supabase_writer, daemon=True).start()
+# Gunicorn workers also flush from the worker_exit hook (gunicorn.conf.py);
+# no SIGTERM handler here, so gunicorn's graceful shutdown stays in charge
+atexit.register(flush_supabase_queue)
+
 # 🔹 Google Calendar API Setup
 SCOPES = ['https://www.googleapis.com/auth/calendar']
-CREDENTIALS_FILE = 'credentials.json'
-TOKEN_FILE = 'token.json'
+CREDENTIALS_FILE = os.getenv('CREDENTIALS_FILE', 'credentials.json')
+TOKEN_FILE = os.getenv('TOKEN_FILE', 'token.json')
+CALENDAR_TIMEOUT = 10  # seconds
+CALENDAR_HTTP_POOL_SIZE = 10
+# Credentials -> idle authorized HTTP clients, reused across requests
+calendar_http_pool = {}
+calendar_http_pool_lock = threading.Lock()
 
-def get_calendar_service():
-    """Authenticate and return Google Calendar service."""
+def save_token(creds):
+    """Write the OAuth token atomically so readers never see a partial file."""
+    tmp_file = f"{TOKEN_FILE}.tmp"
+    with open(tmp_file, 'w') as token:
+        token.write(creds.to_json())
+    os.replace(tmp_file, TOKEN_FILE)
+
+def load_credentials():
+    """Load the stored OAuth token, silently refreshing it if it has expired."""
+    if not os.path.exists(TOKEN_FILE):
+        return None
+    creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    if creds.expired and creds.refresh_token:
+        try:
+            creds.refresh(GoogleAuthRequest())
+            save_token(creds)
+        except Exception as e:
+            logger.error(f"OAuth token refresh failed: {e}")
+            return None
+    return creds if creds.valid else None
+
+def authorize_calendar():
+    """Run the interactive OAuth flow and store the token (local development only)."""
+    flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
+    save_token(flow.run_local_server(port=0))
+
+@functools.lru_cache(maxsize=1)
+def get_calendar_credentials():
+    """Return the stored Google Calendar credentials, or None if they're unusable."""
     if not os.path.exists(CREDENTIALS_FILE):
-        logger.error("Missing credentials.json")
+        logger.error(f"Missing {CREDENTIALS_FILE}")
+        return None
+    try:
+        creds = load_credentials()
+    except Exception as e:
+        logger.error(f"Calendar auth error: {e}")
+        return None
+    if not creds:
+        # Never start the interactive flow from a request; it would block the worker
+        logger.error(f"No usable OAuth token in {TOKEN_FILE}. Run 'python app.py' locally to authorize Google Calendar.")
+    return creds
+
+@functools.lru_cache(maxsize=1)
+def get_calendar_service():
+    """Authenticate and return the shared Google Calendar service."""
+    creds = get_calendar_credentials()
+    if not creds:
         return None
     try:
-        creds = None
-        if os.path.exists(TOKEN_FILE):
-            from google.oauth2.credentials import Credentials
-            creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-        if not creds or not creds.valid:
-            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
-            with open(TOKEN_FILE, 'w') as token:
-                token.write(creds.to_json())
-        return build('calendar', 'v3', credentials=creds)
+        # Use the discovery document bundled with google-api-python-client
+        # instead of fetching it over the network.
+        return build('calendar', 'v3', credentials=creds, static_discovery=True)
     except Exception as e:
         logger.error(f"Calendar auth error: {e}")
         return None
 
-# 🔹 In-memory state (simulating Streamlit session state)
-state = {
-    'chat_history': [],
-    'meeting_details': {},
-    'calendar_service': None
-}
+def reset_calendar_service():
+    """Forget the memoized credentials, service and connections so the token is reloaded."""
+    get_calendar_credentials.cache_clear()
+    get_calendar_service.cache_clear()
+    with calendar_http_pool_lock:
+        calendar_http_pool.clear()
+
+def authorized_http(creds):
+    """Return an authorized HTTP client that keeps its connection open between calls."""
+    return AuthorizedHttp(creds, http=httplib2.Http(timeout=CALENDAR_TIMEOUT))
+
+@contextlib.contextmanager
+def pooled_calendar_http(creds):
+    """Borrow an idle authorized HTTP client for creds and return it to the pool afterwards.
+
+    httplib2 connections can't be shared by concurrent requests, so each one
+    borrows its own; clients outlive the request (and its thread or greenlet),
+    so later inserts reuse the open TLS connection.
+    """
+    with calendar_http_pool_lock:
+        idle = calendar_http_pool.setdefault(creds, [])
+        http = idle.pop() if idle else None
+    if http is None:
+        http = authorized_http(creds)
+    try:
+        yield http
+    finally:
+        with calendar_http_pool_lock:
+            idle = calendar_http_pool.get(creds)
+            # Connections made with credentials reset meanwhile are dropped
+            if idle is not None and len(idle) < CALENDAR_HTTP_POOL_SIZE:
+                idle.append(http)
+
+def insert_calendar_event(service, event):
+    """Insert an event into the primary calendar and notify attendees."""
+    with pooled_calendar_http(get_calendar_credentials()) as http:
+        return service.events().insert(
+            calendarId='primary',
+            body=event,
+            sendNotifications=True
+        ).execute(http=http)
+
+# Authenticate once at startup so the first scheduling request doesn't pay for it
+get_calendar_service()
+
+# 🔹 Per-user session state (chat history and pending meeting details)
+CHAT_HISTORY_LIMIT = 40
+# Signed-cookie sessions must fit in a ~4 KB cookie, or the browser drops it
+COOKIE_CHAT_HISTORY_LIMIT = 6
+CHAT_HISTORY_RESPONSE_SIZE = 20
+
+def chat_session_id():
+    """Return the id that ties this session's archived chat messages together."""
+    return session.setdefault('chat_session_id', uuid.uuid4().hex)
+
+def add_chat_message(role, message):
+    """Append to chat history, archiving the message that falls off to Supabase."""
+    history = session.setdefault('chat_history', [])
+    limit = CHAT_HISTORY_LIMIT if session_redis else COOKIE_CHAT_HISTORY_LIMIT
+    while len(history) >= limit:
+        evicted = history.pop(0)
+        if supabase:
+            enqueue_supabase_insert("chat_history", {
+                'session_id': chat_session_id(),
+                'role': evicted['role'],
+                'message': evicted['message'],
+                'created_at': evicted.get('created_at')
+            })
+    entry = {'role': role, 'message': message, 'created_at': datetime.now(timezone.utc).isoformat()}
+    history.append(entry)
+    session.modified = True
+    # Responses only carry the messages added during this request
+    g.setdefault('new_chat_messages', []).append(entry)
+
+def new_chat_messages():
+    """Return the messages added to chat history during this request."""
+    return g.get('new_chat_messages', [])
+
+def serialize_meeting_details(details):
+    """Return the prompt form of meeting details, or None if there are none."""
+    return orjson.dumps(details, default=str, option=orjson.OPT_NAIVE_UTC).decode() if details else None
+
+def set_meeting_details(details):
+    """Store the pending meeting details along with their serialized prompt form.
+
+    Cookie sessions skip the serialized copy to keep the cookie small.
+    """
+    session['meeting_details'] = details
+    if session_redis:
+        session['meeting_details_json'] = serialize_meeting_details(details)
+
+def meeting_details_json():
+    """Return the serialized pending details, reusing the copy made when they were set."""
+    details_json = session.get('meeting_details_json')
+    if details_json is None and session.get('meeting_details'):
+        # Cookie session, or one written before the copy was kept alongside it
+        details_json = serialize_meeting_details(session['meeting_details'])
+        if session_redis:
+            session['meeting_details_json'] = details_json
+    return details_json
+
+def recent_chat_history():
+    """Return the tail of chat history that is sent back to the client."""
+    return session.get('chat_history', [])[-CHAT_HISTORY_RESPONSE_SIZE:]
+
+# 🔹 Gemini response cache
+RESPONSE_CACHE_SIZE = 2048
+SEMANTIC_CACHE_THRESHOLD = 0.93
+SEMANTIC_CACHE_SCOPES = 256
+EMBEDDING_MODEL = 'models/text-embedding-004'
+# The temp dir is writable on serverless hosts, where the working directory
+# isn't; there the cache lasts as long as the instance, not across cold starts
+RESPONSE_CACHE_DB = os.getenv('RESPONSE_CACHE_DB', os.path.join(tempfile.gettempdir(), 'response_cache.db'))
+# Supabase errors meaning the response_cache table doesn't exist
+MISSING_TABLE_CODES = ('42P01', 'PGRST205')
+RESPONSE_CACHE_ROWS = 20000
+
+# Only CLARIFY replies are reused by similarity, and only within the scope of
+# the turn they answered; meeting JSON and SCHEDULE are reused by exact prompt.
+semantic_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+response_db_lock = threading.Lock()
+# Cleared if the Supabase response_cache table turns out to be missing
+remote_response_cache = supabase is not None
+lookup_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='cache-lookup')
+
+def open_response_cache():
+    """Open the SQLite response cache, creating its table on first use."""
+    try:
+        db = sqlite3.connect(RESPONSE_CACHE_DB, timeout=5, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                   'prompt_hash TEXT PRIMARY KEY, scope TEXT, response TEXT, embedding BLOB, ts INTEGER)')
+        db.execute('CREATE INDEX IF NOT EXISTS cache_ts ON cache (ts)')
+        return db
+    except sqlite3.Error as e:
+        logger.warning(f"Could not open response cache {RESPONSE_CACHE_DB}: {e}")
+        return None
+
+response_db = open_response_cache()
+
+def load_response_cache():
+    """Prune old rows and load saved embeddings into the in-memory semantic index."""
+    if response_db is None:
+        return
+    try:
+        with response_db_lock:
+            response_db.execute('DELETE FROM cache WHERE ts < (SELECT ts FROM cache ORDER BY ts DESC LIMIT 1 OFFSET ?)',
+                                (RESPONSE_CACHE_ROWS,))
+            rows = response_db.execute('SELECT scope, response, embedding FROM cache '
+                                       'WHERE embedding IS NOT NULL ORDER BY ts').fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not load response cache: {e}")
+        return
+    entries = OrderedDict()
+    for scope, response, embedding in rows:
+        if semantic_scope(scope, response) is None:
+            # Saved before meeting JSON was kept out of the semantic tier
+            continue
+        entry = entries.setdefault(scope, ([], []))
+        entries.move_to_end(scope)
+        entry[0].append(np.frombuffer(embedding, dtype=np.float32))
+        entry[1].append(response)
+    while len(entries) > SEMANTIC_CACHE_SCOPES:
+        entries.popitem(last=False)
+    with response_cache_lock:
+        for scope, (vectors, responses) in entries.items():
+            semantic_cache[scope] = {'vectors': np.vstack(vectors), 'responses': responses}
+    logger.info(f"Loaded {len(rows)} cached embeddings from {RESPONSE_CACHE_DB}")
+
+def prompt_hash(prompt):
+    """Return the stable cache key for a prompt."""
+    return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+def embed_text(text):
+    """Return the normalized Gemini embedding for text."""
+    result = genai.embed_content(model=EMBEDDING_MODEL, content=text)
+    vector = np.asarray(result['embedding'], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def semantic_lookup(vector, scope):
+    """Return a cached response whose input is similar enough to vector, if any."""
+    with response_cache_lock:
+        entry = semantic_cache.get(scope)
+        if entry is None:
+            return None
+        scores = entry['vectors'] @ vector
+        best = int(np.argmax(scores))
+        if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+            semantic_cache.move_to_end(scope)
+            return entry['responses'][best]
+    return None
+
+def semantic_scope(scope, response):
+    """Return the scope a response is reused under in the semantic cache, or None.
+
+    Only CLARIFY replies qualify. Meeting JSON carries titles, topics and
+    attendees that the scope doesn't capture ("...with Ramesh" / "...with
+    Suresh"), and a similar input to SCHEDULE may be a refusal ("don't book
+    it yet"), so both are only reused on an exact prompt match.
+    """
+    json_str, reply, _ = split_reply(response)
+    if not json_str and reply.startswith('CLARIFY'):
+        return scope
+    return None
+
+def semantic_store(vector, scope, response):
+    """Remember response for the embedded input under scope."""
+    with response_cache_lock:
+        entry = semantic_cache.get(scope)
+        if entry is None:
+            entry = semantic_cache[scope] = {'vectors': np.empty((0, vector.size), dtype=np.float32), 'responses': []}
+            if len(semantic_cache) > SEMANTIC_CACHE_SCOPES:
+                semantic_cache.popitem(last=False)
+        semantic_cache.move_to_end(scope)
+        entry['vectors'] = np.vstack([entry['vectors'], vector])
+        entry['responses'].append(response)
+
+def remote_response_cache_failed(action, error):
+    """Log a failed Supabase response_cache call, turning the tier off if the table is missing."""
+    global remote_response_cache
+    if any(code in str(error) for code in MISSING_TABLE_CODES):
+        remote_response_cache = False
+        logger.warning(f"Supabase response_cache table not found (see README), disabling the remote response cache: {error}")
+    else:
+        logger.warning(f"Response cache {action} failed: {str(error)}")
+
+def stored_response(key):
+    """Look up a response saved in SQLite or persisted by another host in Supabase."""
+    if response_db is not None:
+        try:
+            with response_db_lock:
+                row = response_db.execute('SELECT response FROM cache WHERE prompt_hash = ?', (key,)).fetchone()
+            if row:
+                return row[0]
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache lookup failed: {e}")
+    if not remote_response_cache:
+        return None
+    try:
+        result = supabase.table("response_cache").select("response").eq("prompt_hash", key).limit(1).execute()
+        return result.data[0]['response'] if result.data else None
+    except Exception as e:
+        remote_response_cache_failed('lookup', e)
+        return None
+
+def store_response(key, response, vector=None, scope=''):
+    """Persist a response in SQLite and Supabase for reuse across restarts and hosts."""
+    if response_db is not None:
+        embedding = vector.tobytes() if vector is not None else None
+        try:
+            with response_db_lock:
+                response_db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                                    (key, scope, response, embedding, int(time.time())))
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache store failed: {e}")
+    if not remote_response_cache:
+        return
+    try:
+        supabase.table("response_cache").upsert({'prompt_hash': key, 'response': response}).execute()
+    except Exception as e:
+        remote_response_cache_failed('store', e)
+
+@functools.lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+def cached_gemini_response(prompt, semantic_text=None, scope=''):
+    """Return Gemini's response for prompt, consulting the shared caches first.
+
+    Failures raise instead of returning, so lru_cache never stores them.
+    """
+    key = prompt_hash(prompt)
+    # The stored-response lookup and the embedding call are independent
+    # round-trips, so run them concurrently
+    stored_future = lookup_executor.submit(stored_response, key)
+    vector_future = lookup_executor.submit(embed_text, semantic_text) if semantic_text else None
+    response = stored_future.result()
+    if response:
+        logger.info(f"Response cache hit (stored): {key}")
+        return response
+
+    vector = None
+    if vector_future:
+        try:
+            vector = vector_future.result()
+            response = semantic_lookup(vector, scope)
+            if response:
+                logger.info(f"Response cache hit (semantic): {semantic_text!r}")
+                return response
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {str(e)}")
+            vector = None
+
+    current = prompt_cache
+    if current is not None and prompt_cache_expired(current):
+        # The refresher missed its window (e.g. the process was suspended)
+        logger.warning("Prompt cache expired, re-creating it")
+        recreate_prompt_cache(current)
+        current = prompt_cache
+    try:
+        response = generate_gemini_reply(prompt)
+    except (google_exceptions.NotFound, google_exceptions.PermissionDenied) as e:
+        # The cached content was deleted or expired server-side; rebuild it once
+        if current is None:
+            raise
+        logger.warning(f"Prompt cache unavailable, re-creating it: {e}")
+        recreate_prompt_cache(current)
+        response = generate_gemini_reply(prompt)
+    scope = semantic_scope(scope, response)
+    if scope is None:
+        vector = None
+    if vector is not None:
+        semantic_store(vector, scope, response)
+    store_response(key, response, vector, scope)
+    return response
+
+CLARIFY_MAX_CHARS = 1000
+
+def stream_gemini_response(prompt):
+    """Stream Gemini's reply and stop as soon as a complete answer has arrived.
+
+    JSON replies end at the closing brace of the first object, SCHEDULE is
+    recognized from its first chunk and a CLARIFY message, which may span
+    several lines (e.g. bulleted options), ends at a blank line or after
+    CLARIFY_MAX_CHARS; anything generated after that is ignored.
+    """
+    buffer = ''
+    for chunk in llm.generate_content(prompt, stream=True):
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. the final finish-reason chunk)
+            continue
+        buffer += text
+        head = buffer.lstrip('`json \n')
+        if head.startswith('SCHEDULE'):
+            return 'SCHEDULE'
+        if head.startswith('CLARIFY'):
+            # A clarifying question may contain braces, so never scan it for JSON
+            if '\n\n' in head:
+                return head[:head.index('\n\n')].strip()
+            if len(head) >= CLARIFY_MAX_CHARS:
+                return head[:CLARIFY_MAX_CHARS].strip()
+            continue
+        if '}' in text:
+            span = find_json_span(buffer)
+            if span:
+                return buffer[:span[1]].strip()
+    if not buffer.strip():
+        raise ValueError("Failed to generate response.")
+    return buffer.strip()
+
+# 🔹 Gemini micro-batching (opt-in via GEMINI_BATCH_WINDOW_MS)
+GEMINI_BATCH_WINDOW = float(os.getenv('GEMINI_BATCH_WINDOW_MS', '0')) / 1000
+GEMINI_MAX_BATCH = 8
+BATCH_PROMPT_HEADER = (
+    "Answer each of the following {count} turns independently, following your instructions for each one. "
+    "Return *only* a JSON array of {count} strings, where element i is your complete response to turn i.\n\n"
+)
+gemini_batch_queue = queue.Queue()
+
+def generate_gemini_reply(prompt):
+    """Get Gemini's reply for prompt, coalescing concurrent calls when batching is on."""
+    if GEMINI_BATCH_WINDOW <= 0:
+        return stream_gemini_response(prompt)
+    future = Future()
+    gemini_batch_queue.put((prompt, future))
+    return future.result()
+
+def run_gemini_batch(batch):
+    """Answer a batch of (prompt, future) pairs with a single Gemini call."""
+    if len(batch) == 1:
+        prompt, future = batch[0]
+        try:
+            future.set_result(stream_gemini_response(prompt))
+        except Exception as e:
+            future.set_exception(e)
+        return
+
+    turns = '\n\n'.join(f"Turn {i}:\n{prompt}" for i, (prompt, _) in enumerate(batch))
+    try:
+        result = llm.generate_content(BATCH_PROMPT_HEADER.format(count=len(batch)) + turns)
+        text = result.text
+        replies = orjson.loads(text[text.find('['):text.rfind(']') + 1])
+        if not (isinstance(replies, list) and len(replies) == len(batch) and all(isinstance(r, str) and r.strip() for r in replies)):
+            raise ValueError(f"expected {len(batch)} replies")
+    except Exception as e:
+        # Fall back to answering each turn on its own, in parallel
+        logger.warning(f"Batched Gemini call failed, answering {len(batch)} turns individually: {e}")
+        for prompt, future in batch:
+            lookup_executor.submit(run_gemini_batch, [(prompt, future)])
+        return
+    logger.info(f"Answered {len(batch)} turns with one Gemini call")
+    for (_, future), reply in zip(batch, replies):
+        future.set_result(reply.strip())
+
+def gemini_batcher():
+    """Collect prompts arriving within GEMINI_BATCH_WINDOW and answer them together."""
+    while True:
+        batch = [gemini_batch_queue.get()]
+        deadline = time.monotonic() + GEMINI_BATCH_WINDOW
+        while len(batch) < GEMINI_MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(gemini_batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Run the call off the collector thread so the next window can fill meanwhile
+        lookup_executor.submit(run_gemini_batch, batch)
+
+if GEMINI_BATCH_WINDOW > 0 and llm:
+    threading.Thread(target=gemini_batcher, daemon=True).start()
+
+# 🔹 Local speech recognition
+WHISPER_MODEL = os.getenv('WHISPER_MODEL', 'small.en')
+WHISPER_SAMPLE_RATE = 16000
 
 # 🔹 Helper Functions
-def get_gemini_response(prompt):
-    """Generate response using Gemini."""
+def get_gemini_response(prompt, semantic_text=None, scope=''):
+    """Generate response using Gemini, reusing cached responses when possible."""
     if not llm:
         return "Gemini API not initialized."
     try:
-        response = llm.generate_content(prompt)
-        if hasattr(response, 'text') and response.text:
-            return response.text.strip()
-        return "Failed to generate response."
+        return cached_gemini_response(prompt, semantic_text, scope)
     except Exception as e:
         logger.error(f"Gemini response failed: {str(e)}")
         return f"Oops, something went wrong: {str(e)}. Could you try again?"
 
+def extract_emails(text):
+    """Return the distinct email addresses in text, whitespace removed and lowercased."""
+    emails = (''.join(match.split()).lower() for match in EMAIL_RE.findall(text))
+    return list(dict.fromkeys(emails))
+
+def plausible_date_hint(phrase, value, today):
+    """Return True if dateparser's reading of phrase is worth passing to Gemini.
+
+    search_dates matches stray words ("m" from "a.m.", "May" in "May I"),
+    reads bare numbers as months and drops weekdays and times it can't
+    anchor; such hints would mislead more than help.
+    """
+    words = re.findall(r'[a-z]+', phrase.lower())
+    if not any(char.isdigit() for char in phrase) and all(len(word) <= 2 or word in MONTH_NAMES for word in words):
+        return False
+    if value.date() < today:
+        return False
+    if any(day in words and value.weekday() != i for i, day in enumerate(WEEKDAYS)):
+        return False
+    if DATE_HINT_TIME_RE.search(phrase) and not (value.hour or value.minute):
+        return False
+    return True
+
+def extract_dates(text, now):
+    """Resolve date/time phrases in text locally, relative to today.
+
+    Returns '"<phrase>" = YYYY-MM-DD HH:MM' hints for the prompt. Emails are
+    removed first so their digits aren't read as dates. Relative phrases are
+    resolved from midnight, so a phrase without a time reads as 00:00.
+    """
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    try:
+        found = search_dates(EMAIL_RE.sub(' ', text), languages=['en'], settings={'RELATIVE_BASE': midnight})
+    except Exception as e:
+        logger.warning(f"Local date parsing failed: {e}")
+        return []
+    return [
+        f'"{phrase}" = {value.strftime("%Y-%m-%d %H:%M")}'
+        for phrase, value in found or []
+        if plausible_date_hint(phrase, value, midnight.date())
+    ]
+
+def parse_start_time(date, time_of_day, timezone):
+    """Build an aware datetime from 'YYYY-MM-DD' and 'HH:MM' strings.
+
+    ZoneInfo instances are cached by the stdlib, so repeated zones are free.
+    """
+    year, month, day = map(int, date.split('-'))
+    hour, minute = map(int, time_of_day.split(':')[:2])
+    return datetime(year, month, day, hour, minute, tzinfo=ZoneInfo(timezone))
+
+def find_json_span(text):
+    """Return (start, end) of the first balanced {...} object in text, or None.
+
+    Single pass tracking brace depth (ignoring braces inside JSON strings), so
+    there is no regex backtracking on large or malformed responses. The
+    precompiled JSON_TOKEN_RE jumps straight between the only characters that
+    can change the scanner state.
+    """
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        return None
+    depth = 0
+    in_string = False
+    skip_until = start
+    # Nothing after the last '}' can close the object, so the scan stops there
+    for match in JSON_TOKEN_RE.finditer(text, start, end + 1):
+        i = match.start()
+        if i < skip_until:
+            # Character escaped by the preceding backslash
+            continue
+        char = text[i]
+        if char == '\\':
+            if in_string:
+                skip_until = i + 2
+        elif in_string:
+            if char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+    return None
+
+def strip_fence(text):
+    """Strip whitespace and ```/```json markdown fence tokens from both ends of text."""
+    text = text.strip()
+    for fence in ('```json', '```'):
+        if text.startswith(fence):
+            text = text[len(fence):]
+            break
+    for fence in ('```json', '```'):
+        if text.endswith(fence):
+            text = text[:-len(fence)]
+            break
+    return text.strip()
+
+def extract_json(text):
+    """Split a Gemini reply into (json_str, before, after) with one scan.
+
+    json_str is the first balanced {...} object, or None (then before holds
+    the whole reply); the surrounding text has markdown fences stripped.
+    """
+    span = find_json_span(text)
+    if not span:
+        return None, strip_fence(text), ''
+    start, end = span
+    return text[start:end], strip_fence(text[:start]), strip_fence(text[end:])
+
+def split_reply(text):
+    """Split a Gemini reply like extract_json, keeping SCHEDULE/CLARIFY replies whole.
+
+    Keyword replies are recognized before the JSON scan, so a clarifying
+    question such as "CLARIFY: which {title}?" isn't cut at its braces.
+    """
+    reply = strip_fence(text)
+    if reply == 'SCHEDULE' or reply.startswith('CLARIFY'):
+        return None, reply, ''
+    return extract_json(text)
+
+def warm_up_text_processing():
+    """Run the per-turn preprocessing once so the first request doesn't pay for it.
+
+    dateparser loads its language data and compiles its patterns lazily on the
+    first search, which costs far more than any later call.
+    """
+    sample = 'Team sync tomorrow at 3 pm with priya@acme.com'
+    extract_dates(sample, datetime.now(DEFAULT_TIMEZONE))
+    extract_emails(sample)
+    split_reply('```json\n{"title": "Team sync"}\n```')
+
+warm_up_text_processing()
+# Loaded once the reply parser above exists, since loading reclassifies rows
+load_response_cache()
+
+@functools.lru_cache(maxsize=1)
+def get_whisper_model():
+    """Load the local Whisper model (int8 on CPU) and warm it up once."""
+    # Imported here so startup doesn't pay for loading CTranslate2, and the
+    # app runs without faster-whisper installed until speech is transcribed
+    from faster_whisper import WhisperModel
+    model = WhisperModel(WHISPER_MODEL, device='cpu', compute_type='int8')
+    # The first transcription initializes the CTranslate2 kernels; pay that on
+    # one second of silence rather than on the user's audio
+    segments, _ = model.transcribe(np.zeros(WHISPER_SAMPLE_RATE, dtype=np.float32), beam_size=1)
+    list(segments)
+    return model
+
 def transcribe_speech(audio_data):
-    """Transcribe speech from audio data, simulating 5-second pause server-side."""
-    recognizer = sr.Recognizer()
+    """Transcribe 16 kHz mono 16-bit PCM audio with the local Whisper model."""
     try:
-        # Simulate audio input (in practice, audio_data would be processed differently)
-        text = recognizer.recognize_google(audio_data)
+        audio = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
+        segments, _ = get_whisper_model().transcribe(audio, vad_filter=True, beam_size=1)
+        text = ' '.join(segment.text.strip() for segment in segments).strip()
+        if not text:
+            return "Oops, I couldn't make out what you said. Could you speak a bit clearer?"
         return text
-    except sr.UnknownValueError:
-        return "Oops, I couldn't make out what you said. Could you speak a bit clearer?"
-    except sr.RequestError as e:
-        return f"Oops, there was a speech recognition issue: {str(e)}. Please try again."
     except Exception as e:
         logger.error(f"Speech transcription failed: {str(e)}")
         return f"Something went wrong while processing your speech: {str(e)}. Let's try that again."
 
 def schedule_meeting(details):
-    """Schedule a meeting in Google Calendar and store in Supabase."""
+    """Schedule a meeting in Google Calendar and queue it for storage in Supabase."""
     try:
-        service = state['calendar_service'] or get_calendar_service()
+        service = get_calendar_service()
         if not service:
+            # Don't memoize a failed authentication
+            reset_calendar_service()
             return None, "Looks like your Google Calendar credentials are missing or invalid. Please ensure credentials.json is in the project directory and re-authenticate."
-        state['calendar_service'] = service
 
         # Ensure summary is a non-empty string
         title = details.get('title', 'Meeting')
@@ -124,16 +1086,21 @@ def schedule_meeting(details):
 
         # Log details for debugging
         logger.info(f"Scheduling meeting with details: {details}")
+        start_time = datetime.fromisoformat(details['start_time'])
 
+        # Generate the event ID client-side so a retried insert can't create a
+        # duplicate event.
+        event_id = uuid.uuid4().hex
         event = {
+            'id': event_id,
             'summary': title,
             'description': description,
             'start': {
-                'dateTime': details['start_time'].isoformat(),
+                'dateTime': start_time.isoformat(),
                 'timeZone': details.get('timezone', 'Asia/Kolkata'),
             },
             'end': {
-                'dateTime': (details['start_time'] + timedelta(minutes=60)).isoformat(),
+                'dateTime': (start_time + MEETING_DURATION).isoformat(),
                 'timeZone': details.get('timezone', 'Asia/Kolkata'),
             },
             'attendees': [{'email': email} for email in details.get('attendees', [])],
@@ -143,206 +1110,203 @@ def schedule_meeting(details):
                 'useDefault': True
             }
         }
-        event = service.events().insert(
-            calendarId='primary',
-            body=event,
-            sendNotifications=True
-        ).execute()
+        try:
+            event = insert_calendar_event(service, event)
+        except HttpError as e:
+            if e.resp.status != 401:
+                raise
+            # Credentials were rejected even after google-auth's own refresh;
+            # rebuild the service from the stored token and retry once.
+            logger.warning("Calendar rejected credentials (401), re-authenticating")
+            reset_calendar_service()
+            service = get_calendar_service()
+            if not service:
+                reset_calendar_service()
+                return None, "Looks like your Google Calendar credentials are missing or invalid. Please ensure credentials.json is in the project directory and re-authenticate."
+            event = insert_calendar_event(service, event)
         logger.info(f"Event created: {event['id']}, Summary: {event['summary']}, Start: {event['start']['dateTime']}")
 
-        # Store in Supabase
+        # Store in Supabase off the request path; the event ID is all the user needs
         if supabase:
-            try:
-                supabase.table("meetings").insert({
-                    'event_id': event['id'],
-                    'title': title,
-                    'start_time': details['start_time'].isoformat(),
-                    'description': description,
-                    'attendees': details.get('attendees', []),
-                    'agenda': agenda
-                }).execute()
-            except Exception as e:
-                logger.error(f"Supabase insert failed: {str(e)}")
-                return event['id'], "Meeting scheduled, but failed to store in Supabase."
+            enqueue_supabase_insert("meetings", {
+                'event_id': event['id'],
+                'title': title,
+                'start_time': details['start_time'],
+                'description': description,
+                'attendees': details.get('attendees', []),
+                'agenda': agenda
+            })
 
         return event['id'], None
     except Exception as e:
         logger.error(f"Meeting scheduling failed: {str(e)}")
         return None, f"Oops, I couldn’t schedule the meeting: {str(e)}. Please check if credentials.json is valid, re-authenticate if needed, and ensure your Google Calendar is accessible."
 
+def schedule_pending_meeting():
+    """Schedule the session's pending meeting and return the assistant's reply."""
+    details = session.get('meeting_details')
+    if not details:
+        return "Hmm, I don’t have any meeting details to schedule yet. Try sharing some details first!"
+    event_id, error = schedule_meeting(details)
+    if not event_id:
+        return error
+    set_meeting_details({})  # Clear details
+    return f"All done! Your meeting’s scheduled with Event ID: {event_id}. Check your Google Calendar and email for the details!"
+
 # 🔹 Routes
 @app.route('/')
 def index():
     """Serve the frontend."""
     return render_template('index.html')
 
+@app.route('/history')
+def history():
+    """Return the recent chat history so the page can restore it on load."""
+    return jsonify({'chat_history': recent_chat_history()})
+
 @app.route('/transcribe', methods=['POST'])
 def transcribe():
     """Process speech or text input and return meeting details or schedule."""
-    user_input = request.json.get('input')
+    payload = request.get_json(silent=True)
+    raw_input = payload.get('input') if isinstance(payload, dict) else None
+    user_input = ' '.join(raw_input.split()) if isinstance(raw_input, str) else ''
     if not user_input:
         return jsonify({
             'error': 'No input provided.',
-            'chat_history': state['chat_history']
+            'append': new_chat_messages()
         }), 400
 
-    state['chat_history'].append({'role': 'user', 'message': user_input})
-    
+    add_chat_message('user', user_input)
+
+    # Handle plain confirm/cancel turns locally instead of asking Gemini
+    prior_details = session.get('meeting_details', {})
+    normalized = user_input.lower()
+    message = None
+    if prior_details and CONFIRM_INTENT_RE.match(normalized):
+        message = schedule_pending_meeting()
+    elif CANCEL_INTENT_RE.match(normalized):
+        set_meeting_details({})
+        message = "Okay, I’ve cleared the meeting details. Share new details whenever you’re ready!"
+    if message:
+        add_chat_message('Assistant', message)
+        logger.info(f"Constructed message (local intent): {message}")
+        return jsonify({
+            'message': message,
+            'append': new_chat_messages()
+        })
+
     # Include prior meeting details in the prompt for context
-    prior_details = state.get('meeting_details', {})
-    prior_details_str = json.dumps(prior_details, default=str) if prior_details else "None"
-
-    prompt = f"""
-    You're a warm, friendly meeting scheduler assistant, like a helpful colleague. The user said: "{user_input}"
-
-    Current date is May 18, 2025. Previous meeting details (if any): {prior_details_str}
-
-    Validate and correct the meeting details (title, date, time, timezone, description, agenda, attendees) from the user's message. Follow these rules:
-    - If the input modifies an existing meeting (e.g., "title as [new title]", "add attendee"), update only the specified fields and retain other prior details unless explicitly changed.
-    - Extract the title if specified; default to "Meeting" if not specified or unclear. Use prior title if input only updates other fields.
-    - Parse date (e.g., "tomorrow" as 2025-05-19, "22 May" as 2025-05-22); ensure it’s on or after May 18, 2025; use prior date if not specified; default to May 18, 2025, only if no prior date and input is unclear.
-    - Parse time in 12-hour (e.g., "9:00 a.m.") or 24-hour format; use prior time if not specified; default to 09:00 if unclear.
-    - Default timezone to Asia/Kolkata if not specified or invalid; retain prior timezone if available.
-    - Extract description if provided; use prior description if not specified; set to empty string if none.
-    - If the user requests "points" or an agenda (e.g., "give some points") or if the title implies a topic (e.g., "machine learning"), generate a default agenda based on the title (e.g., for "machine learning": "1. Overview of machine learning\n2. Use cases\n3. Challenges\n4. Latest advancements\n5. Future directions"); otherwise, use prior agenda or set to empty string.
-    - Parse attendees from natural language (e.g., "Maithili geek@gmail.com" as "maithiligeek@gmail.com"). For names without emails (e.g., "Ramesh"), assign dummy emails (e.g., "ramesh@example.com") and note in the message that emails were assumed. Retain prior attendees unless explicitly changed or removed.
-    - Return corrected details in JSON format *only*:
-      ```json
-      {{
-        "title": "<corrected_title>",
-        "date": "<YYYY-MM-DD>",
-        "time": "<HH:MM>",
-        "timezone": "<valid_timezone>",
-        "description": "<corrected_description>",
-        "agenda": "<corrected_agenda>",
-        "attendees": ["<email1>", "<email2>", ...]
-      }}
-      ```
-    If the user says something like "confirm", "it is confirmed", "schedule it", "set the meeting", or variations (e.g., "confirm confirm", "please set the meeting"), return "SCHEDULE" to schedule immediately.
-    If the input is unclear or lacks sufficient details, return "CLARIFY: Hmm, I couldn’t catch all the details. Could you clarify the title, date, or attendees?"
-
-    Respond with *only* the JSON string, "SCHEDULE", or "CLARIFY:<message>" to avoid parsing issues. Do not include conversational text outside the JSON or CLARIFY message.
-    """
-    response = get_gemini_response(prompt)
+    prior_details_str = meeting_details_json() if prior_details else "None"
+
+    now = datetime.now(DEFAULT_TIMEZONE)
+    today_str = now.strftime('%B %d, %Y')
+    emails_str = ', '.join(extract_emails(user_input)) or 'none'
+    dates_str = ', '.join(extract_dates(user_input, now)) or 'none'
+    prompt = USER_TURN_TEMPLATE.format_map({
+        'today_str': today_str,
+        'user_input': user_input,
+        'emails_str': emails_str,
+        'dates_str': dates_str,
+        'prior_details_str': prior_details_str
+    })
+    # Relative dates resolve differently each day, so the date is part of the
+    # scope; so are the extracted emails and dates, which similar-sounding
+    # requests ("sync at 3pm with alice@x.com" / "sync at 4pm with bob@y.com")
+    # must not share
+    scope = '|'.join((today_str, prior_details_str, emails_str, dates_str))
+    response = get_gemini_response(prompt, semantic_text=user_input, scope=scope)
     logger.info(f"Gemini response: {response}")
 
-    # Clean markdown and extract JSON
-    cleaned_response = response.replace('```json', '').replace('```', '').strip()
+    # Split the reply into the JSON object and the text around it, minus markdown fences
+    json_str, cleaned_response, trailing_text = split_reply(response)
     conversational_message = None
-    json_str = None
-
-    # Try to extract JSON using regex
-    json_match = re.search(r'\{[\s\S]*\}', cleaned_response)
-    if json_match:
-        json_str = json_match.group(0)
-        conversational_message = cleaned_response.replace(json_str, '').strip()
+    if json_str:
+        conversational_message = '\n'.join(part for part in (cleaned_response, trailing_text) if part)
         logger.info(f"Extracted JSON: {json_str}")
         logger.info(f"Conversational message: {conversational_message or 'None'}")
-    else:
-        json_str = cleaned(zone_id='Asia/Kolkata')
+    elif cleaned_response != "SCHEDULE" and not cleaned_response.startswith("CLARIFY"):
+        # Neither JSON nor a known keyword: ask the user to clarify locally
+        # rather than failing on the JSON parse below
+        logger.warning(f"Unrecognized Gemini response: {response}")
+        cleaned_response = "CLARIFY: Hmm, I couldn’t catch all the details. Could you clarify the title, date, or attendees?"
     try:
         if cleaned_response == "SCHEDULE":
-            if state['meeting_details']:
-                event_id, error = schedule_meeting(state['meeting_details'])
-                if event_id:
-                    message = f"All done! Your meeting’s scheduled with Event ID: {event_id}. Check your Google Calendar and email for the details!"
-                    state['meeting_details'] = {}  # Clear details
-                else:
-                    message = error
-                state['chat_history'].append({'role': 'Assistant', 'message': message})
-                logger.info(f"Constructed message: {message}")
-                return jsonify({
-                    'message': message,
-                    'chat_history': state['chat_history']
-                })
-            else:
-                message = "Hmm, I don’t have any meeting details to schedule yet. Try sharing some details first!"
-                state['chat_history'].append({'role': 'Assistant', 'message': message})
-                logger.info(f"Constructed message: {message}")
-                return jsonify({
-                    'message': message,
-                    'chat_history': state['chat_history']
-                })
+            message = schedule_pending_meeting()
+            add_chat_message('Assistant', message)
+            logger.info(f"Constructed message: {message}")
+            return jsonify({
+                'message': message,
+                'append': new_chat_messages()
+            })
         elif cleaned_response.startswith("CLARIFY"):
             message = cleaned_response
-            state['chat_history'].append({'role': 'Assistant', 'message': message})
+            add_chat_message('Assistant', message)
             logger.info(f"Constructed message: {message}")
             return jsonify({
                 'message': message,
-                'chat_history': state['chat_history']
+                'append': new_chat_messages()
             })
         else:
             # Parse JSON
-            corrected_details = json.loads(json_str)
-            start_time = datetime.strptime(
-                f"{corrected_details['date']} {corrected_details['time']}",
-                '%Y-%m-%d %H:%M'
-            ).replace(tzinfo=pytz.timezone(corrected_details['timezone']))
+            corrected_details = orjson.loads(json_str)
+            start_time = parse_start_time(corrected_details['date'], corrected_details['time'], corrected_details['timezone'])
             # Update meeting details incrementally
-            state['meeting_details'] = {
-                'title': corrected_details['title'] or state['meeting_details'].get('title', 'Meeting'),
-                'description': corrected_details['description'] or state['meeting_details'].get('description', ''),
-                'agenda': corrected_details['agenda'] or state['meeting_details'].get('agenda', ''),
-                'start_time': start_time,
-                'attendees': corrected_details['attendees'] or state['meeting_details'].get('attendees', []),
-                'timezone': corrected_details['timezone'] or state['meeting_details'].get('timezone', 'Asia/Kolkata')
+            # start_time is stored as an ISO string so the session stays serializable
+            details = {
+                'title': corrected_details['title'] or prior_details.get('title', 'Meeting'),
+                'description': corrected_details['description'] or prior_details.get('description', ''),
+                'agenda': corrected_details['agenda'] or prior_details.get('agenda', ''),
+                'start_time': start_time.isoformat(),
+                'attendees': corrected_details['attendees'] or prior_details.get('attendees', []),
+                'timezone': corrected_details['timezone'] or prior_details.get('timezone', 'Asia/Kolkata')
             }
-            logger.info(f"Updated meeting details: {state['meeting_details']}")
-            attendees_str = ', '.join(state['meeting_details']['attendees']) if state['meeting_details']['attendees'] else 'no attendees'
-            description_str = state['meeting_details']['description'] or 'none'
-            agenda_str = state['meeting_details']['agenda'] or 'none'
-            message = f"Sir, I’ve got your {state['meeting_details']['title']} set for {start_time.strftime('%Y-%m-%d %H:%M')} {state['meeting_details']['timezone']} with {attendees_str}. Description: {description_str}. Agenda: {agenda_str}. Just say 'Confirm the meeting' to lock it in, or tweak it in the form!"
+            set_meeting_details(details)
+            logger.info(f"Updated meeting details: {details}")
+            attendees_str = ', '.join(details['attendees']) if details['attendees'] else 'no attendees'
+            description_str = details['description'] or 'none'
+            agenda_str = details['agenda'] or 'none'
+            message = f"Sir, I’ve got your {details['title']} set for {start_time.strftime('%Y-%m-%d %H:%M')} {details['timezone']} with {attendees_str}. Description: {description_str}. Agenda: {agenda_str}. Just say 'Confirm the meeting' to lock it in, or tweak it in the form!"
             if conversational_message and conversational_message.strip():
                 message = conversational_message
-            state['chat_history'].append({'role': 'Assistant', 'message': message})
+            add_chat_message('Assistant', message)
             logger.info(f"Constructed message: {message}")
             return jsonify({
                 'message': message,
-                'chat_history': state['chat_history']
+                'append': new_chat_messages()
             })
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.error(f"JSON decode error for response: {response}")
         message = "Oops, I had trouble understanding your meeting details. Could you clarify the title, date, or attendees?"
-        state['chat_history'].append({'role': 'Assistant', 'message': message})
+        add_chat_message('Assistant', message)
         logger.info(f"Constructed message: {message}")
         return jsonify({
             'message': message,
-            'chat_history': state['chat_history']
+            'append': new_chat_messages()
         })
     except Exception as e:
         logger.error(f"Error processing Gemini response: {str(e)}, Response: {response}")
         message = f"Hmm, something went wrong while processing your request: {str(e)}. Could you try again with the details?"
-        state['chat_history'].append({'role': 'Assistant', 'message': message})
+        add_chat_message('Assistant', message)
         logger.info(f"Constructed message: {message}")
         return jsonify({
             'message': message,
-            'chat_history': state['chat_history']
+            'append': new_chat_messages()
         })
 
 @app.route('/schedule', methods=['POST'])
 def schedule():
     """Schedule the current meeting details."""
-    if not state['meeting_details']:
-        message = "Hmm, I don’t have any meeting details to schedule yet. Try sharing some details first!"
-        state['chat_history'].append({'role': 'Assistant', 'message': message})
-        logger.info(f"Constructed message: {message}")
-        return jsonify({
-            'message': message,
-            'chat_history': state['chat_history']
-        })
-    
-    event_id, error = schedule_meeting(state['meeting_details'])
-    if event_id:
-        message = f"All done! Your meeting’s scheduled with Event ID: {event_id}. Check your Google Calendar and email for the details!"
-        state['meeting_details'] = {}  # Clear details
-    else:
-        message = error
-    state['chat_history'].append({'role': 'Assistant', 'message': message})
+    message = schedule_pending_meeting()
+    add_chat_message('Assistant', message)
     logger.info(f"Constructed message: {message}")
     return jsonify({
         'message': message,
-        'chat_history': state['chat_history']
+        'append': new_chat_messages()
     })
 
 if __name__ == '__main__':
+    if os.path.exists(CREDENTIALS_FILE) and not load_credentials():
+        authorize_calendar()
+        # The startup call above memoized the missing credentials
+        reset_calendar_service()
     app.run(debug=True)
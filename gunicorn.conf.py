@@ -0,0 +1,22 @@
+import multiprocessing
+import os
+import sys
+
+# The app spends almost all of its time waiting on external APIs, so each
+# gevent worker can keep many requests in flight.
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_connections = 1000
+
+# Without a shared key each worker signs sessions with its own random one, so
+# a request landing on another worker would lose the user's session
+if workers > 1 and not os.getenv('FLASK_SECRET_KEY'):
+    raise RuntimeError("Set FLASK_SECRET_KEY when running more than one worker")
+
+def worker_exit(server, worker):
+    """Write the worker's queued Supabase rows before it exits."""
+    # Only workers that loaded the app have anything queued
+    app_module = sys.modules.get('app')
+    if app_module:
+        app_module.flush_supabase_queue()
@@ -0,0 +1,12 @@
+"""WSGI entry point for production: gunicorn -c gunicorn.conf.py wsgi:app"""
+# Patch blocking I/O before anything imports sockets, so Gemini, Calendar and
+# Supabase round-trips yield to other requests instead of blocking the worker.
+from gevent import monkey
+monkey.patch_all()
+
+# google-generativeai talks gRPC, whose C core ignores the patched sockets;
+# this makes its calls yield to the gevent loop too.
+import grpc.experimental.gevent  # noqa: E402
+grpc.experimental.gevent.init_gevent()
+
+from app import app  # noqa: E402,F401